@@ -1,10 +1,18 @@
 import gradio as gr
 import requests
 import pandas as pd
+import numpy as np
 import math
 import time
 import os
 import logging
+import hashlib
+from collections import OrderedDict
+from types import MappingProxyType
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from requests_toolbelt import MultipartEncoder
+import orjson
 from opencensus.ext.azure.log_exporter import AzureLogHandler
 from dotenv import load_dotenv
 
@@ -35,50 +43,150 @@ if APPINSIGHTS_CONNECTION_STRING:
     logger.addHandler(azure_handler)
     logger.info("Application Insights logger configured.")
 
+# --- HTTP Session ---
+# A shared session keeps connections to the webhook host alive between invoices.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    # Retry only failed connects: a POST whose body was sent must not be replayed.
+    max_retries=Retry(total=2, read=0, status=0, backoff_factor=0.3)
+))
+_SESSION.headers.update({'Authorization': f'Bearer {BEARER_TOKEN}'})
+
+# --- Result Cache ---
+# Analysis results (webhook JSON, header HTML, KPI cards, line items, validation verdict) keyed by the
+# SHA-256 of the uploaded PDF, so a repeat upload skips the webhook round-trip and all rendering.
+_RESULT_CACHE_MAX_SIZE = 32
+_RESULT_CACHE: "OrderedDict[str, dict]" = OrderedDict()
+
+# Upper bound on the webhook response body we are willing to parse.
+_MAX_RESPONSE_BYTES = 50 * 1024 * 1024
+
+
+def _parse_webhook_response(response):
+    """Read a streamed webhook response up to the size cap and decode it with orjson."""
+    body = bytearray()
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        body += chunk
+        if len(body) > _MAX_RESPONSE_BYTES:
+            raise requests.exceptions.RequestException(
+                f"Webhook response too large: over {_MAX_RESPONSE_BYTES} bytes"
+            )
+    return orjson.loads(body)
+
 # --- SVG Icons ---
-KPI_ICONS = {
+KPI_ICONS = MappingProxyType({
     "prompt": """<svg xmlns="http://www.w3.org/2000/svg" class="icon" fill="none" viewBox="0 0 24 24" stroke="currentColor" stroke-width="2"><path stroke-linecap="round" stroke-linejoin="round" d="M10 20l4-16m4 4l-4 4-4-4-4 4" /></svg>""",
     "tokens": """<svg xmlns="http://www.w3.org/2000/svg" class="icon" fill="none" viewBox="0 0 24 24" stroke="currentColor" stroke-width="2"><path stroke-linecap="round" stroke-linejoin="round" d="M9 7h6m0 10v-3m-3 3h.01M9 17h.01M9 14h.01M12 14h.01M15 11h.01M12 11h.01M9 11h.01M12 8h.01M15 8h.01M15 14h.01M18 8h.01M6 8h.01M6 11h.01M6 14h.01M6 17h.01" /></svg>""",
     "cost": """<svg xmlns="http://www.w3.org/2000/svg" class="icon" fill="none" viewBox="0 0 24 24" stroke="currentColor" stroke-width="2"><path stroke-linecap="round" stroke-linejoin="round" d="M12 8c-1.657 0-3 .895-3 2s1.343 2 3 2 3 .895 3 2-1.343 2-3 2m0-8c1.11 0 2.08.402 2.599 1M12 8V7m0 1v.01" /></svg>""",
     "lines": """<svg xmlns="http://www.w3.org/2000/svg" class="icon" fill="none" viewBox="0 0 24 24" stroke="currentColor" stroke-width="2"><path stroke-linecap="round" stroke-linejoin="round" d="M4 6h16M4 10h16M4 14h16M4 18h16" /></svg>"""
-}
+})
+
+# Static KPI card HTML, built once; only the value is filled in per request.
+KPI_TITLES = MappingProxyType({
+    "prompt": "Prompt Version",
+    "tokens": "Tokens Used",
+    "cost": "Cost Incurred",
+    "lines": "Line Items"
+})
+_KPI_TEMPLATES = MappingProxyType({
+    key: (f"<div class='kpi-icon'>{icon}</div><div><h3>{KPI_TITLES[key]}</h3><p>", "</p></div>")
+    for key, icon in KPI_ICONS.items()
+})
+
+
+def _kpi_html(key, value):
+    pre, post = _KPI_TEMPLATES[key]
+    return pre + str(value) + post
+
+# --- Service Location HTML ---
+def _service_locations_html(service_locations):
+    """Render each service location as a <dt>/<dd> pair."""
+    parts = []
+    parts_append = parts.append
+    for loc in service_locations:
+        addr = loc.get('address', {})
+        full_address = f"{addr.get('street', '') or ''} {addr.get('city', '') or ''}, {addr.get('state', '') or ''} {addr.get('zip', '') or ''}".strip(", ")
+        parts_append(f"<dt>{loc.get('location_name', 'N/A')}</dt><dd>{full_address or 'Address not found'}</dd>")
+    return "".join(parts)
+
+# --- Amount Parsing ---
+# Translation table that drops thousands separators from amounts like "1,234.56".
+_STRIP_COMMA = str.maketrans('', '', ',')
+
+# --- UI Update Helpers ---
+def _error_updates(status_html):
+    """Positional updates that show an error status and reset the dashboard to the placeholder."""
+    return (
+        gr.update(value=status_html),  # status_output
+        gr.update(visible=False),  # results_col
+        gr.update(visible=True),  # placeholder_col
+        gr.update(),  # results_header
+        gr.update(),  # kpi_prompt
+        gr.update(),  # kpi_tokens
+        gr.update(),  # kpi_cost
+        gr.update(),  # kpi_lines
+        gr.update(),  # line_items_table
+        gr.update(),  # json_output
+        gr.update(visible=False),  # validated_status_box
+        gr.update(visible=False),  # mismatch_status_box
+    )
+
+def _result_updates(result):
+    """Positional updates that render a (possibly cached) analysis result on the dashboard."""
+    kpi_prompt_html, kpi_tokens_html, kpi_cost_html, kpi_lines_html = result['kpi_html']
+    mismatch_text = result['mismatch_text']
+    # Fresh update dicts are built on each call so cached results are never mutated by Gradio.
+    return (
+        gr.update(value="<div class='status-box success'>✅ Analysis Complete.</div>"),  # status_output
+        gr.update(visible=True),  # results_col
+        gr.update(visible=False),  # placeholder_col
+        gr.update(value=result['header_html']),  # results_header
+        gr.update(value=kpi_prompt_html),  # kpi_prompt
+        gr.update(value=kpi_tokens_html),  # kpi_tokens
+        gr.update(value=kpi_cost_html),  # kpi_cost
+        gr.update(value=kpi_lines_html),  # kpi_lines
+        gr.update(value=result['line_items_df']),  # line_items_table
+        gr.update(value=result['json_data']),  # json_output
+        gr.update(visible=result['validated']),  # validated_status_box
+        gr.update(visible=True, value=mismatch_text) if mismatch_text else gr.update(visible=False),  # mismatch_status_box
+    )
 
-# --- Data Processing Function ---
 # --- Data Processing Function ---
 def process_invoice_data(pdf_file, progress=gr.Progress()):
-    initial_updates = {
-        status_output: gr.update(value=""),
-        results_col: gr.update(visible=False),
-        placeholder_col: gr.update(visible=True),
-        validated_status_box: gr.update(visible=False),
-        mismatch_status_box: gr.update(visible=False)
-    }
     if pdf_file is None:
         logger.warning("Invoice processing attempt failed: No PDF file was uploaded.")
-        initial_updates[status_output] = gr.update(value="<div class='status-box error'>❌ Please upload a PDF file.</div>")
-        return initial_updates
+        return _error_updates("<div class='status-box error'>❌ Please upload a PDF file.</div>")
 
     filename = os.path.basename(pdf_file.name)
     logger.info("Starting invoice processing for: %s", filename)
-    headers = {'Authorization': f'Bearer {BEARER_TOKEN}'}
-    
+
     try:
         progress(0, desc="🚀 Analyzing Document...")
         with open(pdf_file.name, 'rb') as f:
-            files = {'file': (pdf_file.name, f, 'application/pdf')}
-            response = requests.post(N8N_WEBHOOK_URL, headers=headers, files=files, timeout=600)
+            digest = hashlib.file_digest(f, 'sha256').hexdigest()
+            result = _RESULT_CACHE.get(digest)
+            if result is not None:
+                _RESULT_CACHE.move_to_end(digest)
+                logger.info("Using cached analysis for: %s", filename)
+                return _result_updates(result)
+            f.seek(0)
+            # Stream the multipart body from the open file rather than buffering it in memory.
+            encoder = MultipartEncoder(fields={'file': (pdf_file.name, f, 'application/pdf')})
+            response = _SESSION.post(N8N_WEBHOOK_URL, headers={'Content-Type': encoder.content_type}, data=encoder, timeout=600, stream=True)
+        # The streamed response is closed on every path, including error statuses, to release its connection.
+        with response:
             response.raise_for_status()
-        logger.info("Successfully received data from webhook for: %s", filename)
+            logger.info("Successfully received data from webhook for: %s", filename)
+            json_data = _parse_webhook_response(response)
         progress(0.9, desc="✅ Success! Formatting results...")
-        json_data = response.json()
 
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
         logger.error("Request to webhook failed for file: %s. Error: %s", filename, str(e), exc_info=True)
-        initial_updates[status_output] = gr.update(value=f"<div class='status-box error'>❌ A network error occurred.</div>")
-        return initial_updates
+        return _error_updates("<div class='status-box error'>❌ A network error occurred.</div>")
 
     try:
-        json_data = response.json()
         content = json_data.get('message', {}).get('content', {})
         
         prompt_version = content.get('Prompt_Version', 'N/A')
@@ -86,35 +194,52 @@ def process_invoice_data(pdf_file, progress=gr.Progress()):
         
         # FIX: Handle potential commas in cost value.
         cost_raw = content.get('GPTCostIncurred', '0')
-        cost = f"${float(str(cost_raw).replace(',', '')):.4f}"
+        cost = f"${float(str(cost_raw).translate(_STRIP_COMMA)):.4f}"
 
         line_items_raw = content.get('service_locations', [{}])[0].get('line_items', [])
         line_count = len(line_items_raw)
         
+        # --- Build Line Items DataFrame ---
+        # The numeric 'Total' column is parsed once and reused for validation.
+        rows = [
+            (item.get('date'), item.get('description'), item.get('quantity'), item.get('total', '0'))
+            for item in line_items_raw
+        ]
+        dates, descriptions, quantities, totals_raw = zip(*rows) if rows else ((), (), (), ())
         # FIX: Handle potential commas in line item totals and the main invoice total.
-        line_total_sum = sum(float(str(item.get('total', '0')).replace(',', '')) for item in line_items_raw)
+        parsed_totals = pd.to_numeric(
+            pd.Series(totals_raw, dtype=object).astype(str).str.translate(_STRIP_COMMA), errors='coerce'
+        )
+        unparsed_totals = parsed_totals.isna().to_numpy()
+        if unparsed_totals.any():
+            logger.warning("Unparseable line item totals for %s on lines %s; treating them as $0.00.",
+                           filename, (np.flatnonzero(unparsed_totals) + 1).tolist())
+        totals = parsed_totals.fillna(0.0).to_numpy(dtype=np.float64)
+        # Columns are assembled directly so pandas skips row-wise type inference.
+        line_items_df = pd.DataFrame({
+            'Line #': np.arange(1, line_count + 1, dtype=np.int32),
+            'Date': list(dates),
+            'Description': list(descriptions),
+            'Qty': list(quantities),
+            'Total': totals,
+        }, copy=False)
+        line_total_sum = float(totals.sum())
         invoice_total_raw = content.get('invoice_total', '0')
-        invoice_total = float(str(invoice_total_raw).replace(',', ''))
+        invoice_total = float(str(invoice_total_raw).translate(_STRIP_COMMA))
         
         # Determine which status box to show
-        validation_status_update = gr.update(visible=False)
-        mismatch_status_update = gr.update(visible=False)
-        if math.isclose(invoice_total, line_total_sum, rel_tol=1e-2):
+        validated = math.isclose(invoice_total, line_total_sum, rel_tol=1e-2)
+        mismatch_text = None
+        if validated:
             logger.info("Validation successful for %s. Invoice Total: $%s, Line Sum: $%s", filename, invoice_total, line_total_sum)
-            validation_status_update = gr.update(visible=True)
         else:
             logger.warning("Validation mismatch for %s. Invoice Total: $%s, Line Sum: $%s", filename, invoice_total, line_total_sum)
-            mismatch_status_update = gr.update(visible=True, value=f"MISMATCH (Lines Sum: ${line_total_sum:,.2f})")
+            mismatch_text = f"MISMATCH (Lines Sum: ${line_total_sum:,.2f})"
 
         
         # --- Build Enhanced Header HTML ---
         # ... (HTML building logic remains the same)
-        service_locations_html = ""
-        service_locations_data = content.get('service_locations', [])
-        for loc in service_locations_data:
-            addr = loc.get('address', {})
-            full_address = f"{addr.get('street', '') or ''} {addr.get('city', '') or ''}, {addr.get('state', '') or ''} {addr.get('zip', '') or ''}".strip(", ")
-            service_locations_html += f"<dt>{loc.get('location_name', 'N/A')}</dt><dd>{full_address or 'Address not found'}</dd>"
+        service_locations_html = _service_locations_html(content.get('service_locations', []))
 
         header_html = f"""
             <div class='results-header-grid'>
@@ -128,47 +253,36 @@ def process_invoice_data(pdf_file, progress=gr.Progress()):
             </div>
         """
         
-        # --- Build Line Items DataFrame with Total Row ---
-        line_items_df = pd.DataFrame([
-            {
-                "Line #": i, 
-                "Date": item.get('date'), 
-                "Description": item.get('description'), 
-                "Qty": item.get('quantity'), 
-                # FIX: Handle potential commas here as well to ensure data is numeric.
-                "Total": float(str(item.get('total', '0')).replace(',', ''))
-            }
-            for i, item in enumerate(line_items_raw, 1)
-        ])
-
+        # --- Append Total Row to Line Items DataFrame ---
         if not line_items_df.empty:
-            total_row = pd.DataFrame([{'Description': 'Subtotal', 'Total': line_total_sum}], index=[''])
-            line_items_df = pd.concat([line_items_df, total_row])
+            line_items_df.loc[''] = {'Line #': '', 'Date': '', 'Description': 'Subtotal', 'Qty': '', 'Total': line_total_sum}
             # Format the 'Total' column as currency string for display
-            line_items_df['Total'] = line_items_df['Total'].apply(lambda x: f"${x:,.2f}" if pd.notna(x) else "")
+            line_items_df['Total'] = line_items_df['Total'].map("${:,.2f}".format)
         
         
-        final_updates = {
-            status_output: gr.update(value="<div class='status-box success'>✅ Analysis Complete.</div>"),
-            results_col: gr.update(visible=True),
-            placeholder_col: gr.update(visible=False),
-            results_header: gr.update(value=header_html),
-            kpi_prompt: gr.update(value=f"<div class='kpi-icon'>{KPI_ICONS['prompt']}</div><div><h3>Prompt Version</h3><p>{prompt_version}</p></div>"),
-            kpi_tokens: gr.update(value=f"<div class='kpi-icon'>{KPI_ICONS['tokens']}</div><div><h3>Tokens Used</h3><p>{tokens_used}</p></div>"),
-            kpi_cost: gr.update(value=f"<div class='kpi-icon'>{KPI_ICONS['cost']}</div><div><h3>Cost Incurred</h3><p>{cost}</p></div>"),
-            kpi_lines: gr.update(value=f"<div class='kpi-icon'>{KPI_ICONS['lines']}</div><div><h3>Line Items</h3><p>{line_count}</p></div>"),
-            line_items_table: gr.update(value=line_items_df),
-            json_output: gr.update(value=json_data),
-            validated_status_box: validation_status_update,
-            mismatch_status_box: mismatch_status_update,
+        result = {
+            'header_html': header_html,
+            'kpi_html': (
+                _kpi_html('prompt', prompt_version),
+                _kpi_html('tokens', tokens_used),
+                _kpi_html('cost', cost),
+                _kpi_html('lines', line_count),
+            ),
+            'line_items_df': line_items_df,
+            'json_data': json_data,
+            'validated': validated,
+            'mismatch_text': mismatch_text,
         }
+        # Only successfully built results are cached, so a bad payload is re-fetched on retry.
+        _RESULT_CACHE[digest] = result
+        if len(_RESULT_CACHE) > _RESULT_CACHE_MAX_SIZE:
+            _RESULT_CACHE.popitem(last=False)
         logger.info("Successfully completed analysis for: %s", filename)
-        return final_updates
+        return _result_updates(result)
         
     except Exception as e:
         logger.error("Failed to parse webhook response for file: %s. Error: %s", filename, str(e), exc_info=True)
-        initial_updates[status_output] = gr.update(value=f"<div class='status-box error'>❌ Error processing response data.</div>")
-        return initial_updates
+        return _error_updates("<div class='status-box error'>❌ Error processing response data.</div>")
 # --- CSS Block Inspired by Salient Tailwind UI ---
 css = """
 body, #root { font-family: 'Inter', -apple-system, BlinkMacSystemFont, sans-serif; background-color: #f3f4f6; }